@@ -1,13 +1,73 @@
-from collections import defaultdict
-from collections.abc import Awaitable, Callable, Mapping
-from functools import cached_property
+from collections.abc import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    ItemsView,
+    KeysView,
+    Mapping,
+    ValuesView,
+)
 from json import dumps, loads
 from logging import getLogger
+from re import compile as re_compile
+from sys import intern
 from typing import Any, Iterator
-from urllib.parse import SplitResult, parse_qs, quote, urlsplit
+from urllib.parse import parse_qs, quote, urlsplit
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore[assignment]
 
 LOGGER = getLogger(__name__)
 
+_MISSING: Any = object()
+_LOWER_TABLE = bytes.maketrans(bytes(range(0x41, 0x5B)), bytes(range(0x61, 0x7B)))
+_COMMON_HEADERS = (
+    "accept",
+    "accept-encoding",
+    "accept-language",
+    "authorization",
+    "cache-control",
+    "connection",
+    "content-length",
+    "content-type",
+    "cookie",
+    "host",
+    "if-modified-since",
+    "if-none-match",
+    "origin",
+    "referer",
+    "upgrade",
+    "user-agent",
+    "x-forwarded-for",
+    "x-forwarded-host",
+    "x-forwarded-proto",
+    "x-request-id",
+)
+# Interned lowercase names of common headers by their usual spellings
+_HEADER_NAMES = {
+    spelling: intern(name)
+    for name in _COMMON_HEADERS
+    for spelling in (name, name.title())
+}
+_RAW_HEADER_NAMES = {
+    spelling.encode(): name for spelling, name in _HEADER_NAMES.items()
+}
+# Number of values after which appending checks duplicates against a set
+_SEEN_THRESHOLD = 8
+# Integers from 19 digits on could overflow 64 bits, which orjson parses as floats
+_LONG_DIGITS = re_compile(rb"\d{19}")
+
+
+def _lower_value(b_value: bytes) -> str:
+    """Decodes a raw header value in lowercase."""
+    value = b_value.translate(_LOWER_TABLE).decode()
+    # Non-ASCII letters are only lowercased by `str.lower`
+    if not value.isascii():
+        value = value.lower()
+    return value
+
 
 class Cilantro:
     def __init__(self, name: str):
@@ -38,28 +98,53 @@ class Headers(Mapping):
         Any headers object with the same keys and values are considered equal.
     """
 
+    __slots__ = ("_headers", "_dict")
+
     def __init__(self, headers: list[tuple[bytes, bytes]] | dict[str, str]):
         if isinstance(headers, dict):
             self._headers = [(k.encode(), v.encode()) for k, v in headers.items()]
         else:
             self._headers = headers
 
-        self._dict = defaultdict(list)
+        self._dict: dict[str, list[str]] = {}
         if isinstance(headers, dict):
             for k, v in headers.items():
-                self._dict[k.lower()].append(v)
+                self._add(k.lower(), v)
         else:
+            d = self._dict
             for b_key, b_value in headers:
-                key, value = b_key.decode().lower(), b_value.decode().lower()
-                self._dict[key].append(value)
-            # Duplicates could exist
-            for key, values in self._dict.items():
-                self._dict[key] = list(dict.fromkeys(values))
+                key = _RAW_HEADER_NAMES.get(b_key)
+                if key is None:
+                    # Keys are usually lowercase already, e.g. always for HTTP/2
+                    if not b_key.islower():
+                        b_key = b_key.translate(_LOWER_TABLE)
+                    # Lowercase in bytes first, which is a single C-level pass
+                    key = b_key.decode()
+                    # Non-ASCII letters are only lowercased by `str.lower`
+                    if not key.isascii():
+                        key = key.lower()
+                value = _lower_value(b_value)
+                # Inlined `_add` as this runs for every request header
+                values = d.get(key)
+                if values is None:
+                    d[key] = [value]
+                elif value not in values:
+                    values.append(value)
+
+    def _add(self, key: str, value: str) -> None:
+        """Adds a value under a lowercase key, skipping duplicates."""
+        values = self._dict.get(key)
+        if values is None:
+            self._dict[key] = [value]
+        # Duplicates could exist
+        elif value not in values:
+            values.append(value)
 
     def __getitem__(self, key: str) -> list[str]:
-        if key not in self:
-            raise KeyError
-        return self._dict[key.lower()]
+        values = self._dict.get(_HEADER_NAMES.get(key) or key.lower(), _MISSING)
+        if values is _MISSING:
+            raise KeyError(key)
+        return values
 
     def __iter__(self) -> Iterator[str]:
         return iter(self._dict)
@@ -68,14 +153,25 @@ class Headers(Mapping):
         return len(self._dict)
 
     def __contains__(self, key: Any) -> bool:
-        return key.lower() in self._dict
+        return (_HEADER_NAMES.get(key) or key.lower()) in self._dict
 
     def __eq__(self, other: Any) -> bool:
         if not isinstance(other, Headers):
             return False
-        return len(self._dict) == len(other._dict) and all(
-            sorted(self[key]) == sorted(other[key]) for key in self._dict
-        )
+        d, other_d = self._dict, other._dict
+        if len(d) != len(other_d):
+            return False
+        for key, values in d.items():
+            other_values = other_d.get(key)
+            if other_values is None:
+                return False
+            # Only multiple values need to be compared regardless of order
+            if len(values) == 1:
+                if values != other_values:
+                    return False
+            elif sorted(values) != sorted(other_values):
+                return False
+        return True
 
     def __str__(self) -> str:
         return str(self.raw)
@@ -88,35 +184,60 @@ class Headers(Mapping):
         """The original headers data."""
         return self._headers
 
+    # Views of the internal dict instead of the pure-Python `Mapping` mixins
+    def keys(self) -> KeysView[str]:
+        return self._dict.keys()
+
+    def values(self) -> ValuesView[list[str]]:
+        return self._dict.values()
+
+    def items(self) -> ItemsView[str, list[str]]:
+        return self._dict.items()
+
     def get(self, key: str, default: Any = None) -> Any:
         """Gets the first value of a header key, or a default value if not found."""
-        if key not in self:
-            return default
-        return self[key][0]
+        values = self._dict.get(_HEADER_NAMES.get(key) or key.lower())
+        return values[0] if values else default
 
     def list(self, key: str) -> list[str]:
         """Lists all values of a header key in the original order."""
-        if key not in self:
-            return []
-        return self[key]
+        return self._dict.get(_HEADER_NAMES.get(key) or key.lower(), [])
 
 
 class MutableHeaders(Headers):
     """A mutable case-insensitive class for HTTP headers."""
 
+    __slots__ = ("_seen",)
+
+    def __init__(self, headers: list[tuple[bytes, bytes]] | dict[str, str]):
+        super().__init__(headers)
+        # Sets of values for keys with many values, e.g. `set-cookie`
+        self._seen: dict[str, set[str]] = {}
+
     def __setitem__(self, key: str, value: str) -> None:
         # TODO: validation
-        self._dict[key.lower()] = [value]
+        lower_key = key.lower()
+        self._dict[lower_key] = [value]
+        self._seen.pop(lower_key, None)
 
     def __delitem__(self, key: str) -> None:
-        del self._dict[key.lower()]
+        lower_key = key.lower()
+        del self._dict[lower_key]
+        self._seen.pop(lower_key, None)
 
     def append(self, key: str, value: str) -> None:
         """Appends a value if the key exists, otherwise creates a new key."""
-        if key not in self:
-            self[key] = value
-        elif value not in self[key]:
-            self._dict[key.lower()].append(value)
+        lower_key = key.lower()
+        values = self._dict.get(lower_key)
+        if values is None or len(values) < _SEEN_THRESHOLD:
+            self._add(lower_key, value)
+            return
+        seen = self._seen.get(lower_key)
+        if seen is None:
+            seen = self._seen[lower_key] = set(values)
+        if value not in seen:
+            seen.add(value)
+            values.append(value)
 
     def set(self, key: str, value: str) -> None:
         """Sets a value for a key, overwriting any existing values."""
@@ -146,14 +267,31 @@ class Request:
         Two Request objects are equal if they are the same object.
     """
 
+    __slots__ = (
+        "_scope",
+        "_receive",
+        "_send",
+        "_is_disconnected",
+        "_is_streamed",
+        "_body",
+        "_json",
+        "_url_cache",
+        "_headers_cache",
+        "_query_params_cache",
+    )
+    # Only set once read, see `get_body` and `get_json`
+    _body: bytes
+    _json: dict
+
     def __init__(self, scope: Scope, receive: Receive, send: Send):
         self._scope = scope
         self._receive = receive
         self._send = send
         self._is_disconnected = False
-
-    def __eq__(self, other: Any):
-        return self is other
+        self._is_streamed = False
+        self._url_cache: str | None = None
+        self._headers_cache: Headers | None = None
+        self._query_params_cache: dict[str, list[str]] | None = None
 
     def __str__(self) -> str:
         return f'Request("{self.url}")'
@@ -162,13 +300,27 @@ class Request:
     def method(self) -> str:
         return self._scope["method"]
 
-    @cached_property
-    def _components(self) -> SplitResult:
+    @property
+    def url(self) -> str:
+        url = self._url_cache
+        if url is None:
+            url = self._url_cache = self._build_url()
+        return url
+
+    def _build_url(self) -> str:
         scheme = self._scope.get("scheme", "http")
         path = self._scope["path"]
         server = self._scope.get("server")
 
-        header_host = self.headers.get("host")
+        if self._headers_cache is not None:
+            header_host = self._headers_cache.get("host")
+        else:
+            # Find the host header without decoding all the headers
+            header_host = None
+            for b_key, b_value in self._scope["headers"]:
+                if b_key.lower() == b"host":
+                    header_host = _lower_value(b_value)
+                    break
         if header_host:
             _url = f"{scheme}://{header_host}{path}"
         elif not server:
@@ -179,55 +331,161 @@ class Request:
             _url = f"{scheme}://{host}{colon_port}{path}"
 
         query_string = self._scope["query_string"].decode()
-        return urlsplit(f"{_url}?{query_string}")
-
-    @property
-    def url(self) -> str:
-        return self._components.geturl()
+        return urlsplit(f"{_url}?{query_string}").geturl()
 
     @property
     def scheme(self) -> str:
-        return self._components.scheme
+        return self._scope.get("scheme", "http")
 
     @property
     def path(self) -> str:
-        return self._components.path
+        return self._scope["path"]
 
     @property
     def http_version(self) -> str:
         return self._scope["http_version"]
 
-    @cached_property
+    @property
     def headers(self) -> Headers:
-        return Headers(self._scope["headers"])
+        headers = self._headers_cache
+        if headers is None:
+            headers = self._headers_cache = Headers(self._scope["headers"])
+        return headers
 
     @property
     def query_params(self) -> dict[str, list[str]]:
-        return parse_qs(self._components.query)
+        query_params = self._query_params_cache
+        if query_params is None:
+            query_params = self._query_params_cache = self._parse_query_string()
+        # The parse is cached, but callers get their own copy to change freely
+        return {name: values[:] for name, values in query_params.items()}
+
+    def _parse_query_string(self) -> dict[str, list[str]]:
+        query_string = self._scope["query_string"].decode()
+        if "&" in query_string or "%" in query_string or "+" in query_string:
+            return parse_qs(query_string)
+        # A single pair needing no unquoting is common, e.g. `?page=2`
+        name, _, value = query_string.partition("=")
+        # Same as `parse_qs`, blank values are dropped
+        return {name: [value]} if value else {}
+
+    async def _receive_body(self) -> tuple[bytes, bool]:
+        """Receives the next body chunk and whether more of it will follow."""
+        # Nothing more can be received once the client is gone
+        if self._is_disconnected:
+            raise RuntimeError("Request is disconnected")
+        event = await self._receive()
+        if event["type"] != "http.request":
+            self._is_disconnected = True
+            raise RuntimeError("Request is disconnected")
+        return event.get("body", b""), event.get("more_body", False)
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """Yields the body in chunks as they are received, without buffering.
+
+        The body can only be streamed once, unless it's already read by `get_body`.
+        """
+        try:
+            body = self._body
+        except AttributeError:
+            pass
+        else:
+            if body:
+                yield body
+            return
+        if self._is_streamed:
+            raise RuntimeError("Request body is already streamed")
+
+        self._is_streamed = True
+        more_body = True
+        while more_body:
+            body, more_body = await self._receive_body()
+            if body:
+                yield body
 
     async def get_body(self) -> bytes:
-        if not hasattr(self, "_body"):
-            chunks = []
-            more_body = True
-            while more_body:
-                event = await self._receive()
-                if event["type"] == "http.request":
-                    body = event.get("body", b"")
-                    more_body = event.get("more_body", False)
-                    chunks.append(body)
-                else:
-                    self._is_disconnected = True
-                    raise RuntimeError("Request is disconnected")
-            self._body = b"".join(chunks)
+        try:
+            return self._body
+        except AttributeError:
+            pass
+        if self._is_streamed:
+            raise RuntimeError("Request body is already streamed")
+
+        buffer = bytearray()
+        more_body = True
+        while more_body:
+            body, more_body = await self._receive_body()
+            if not more_body and not buffer:
+                # The whole body usually comes in one event, no need to copy
+                self._body = body
+                return body
+            buffer += body
+        self._body = bytes(buffer)
         return self._body
 
     async def get_json(self) -> dict:
-        if not hasattr(self, "_json"):
-            body = await self.get_body()
-            self._json = loads(body.decode())
+        """Parses the body as JSON, by orjson if it's installed.
+
+        Bodies orjson rejects, e.g. with NaN or Infinity, or may parse lossily, i.e.
+        with integers wider than 64 bits, are parsed by the `json` module instead.
+        """
+        try:
+            return self._json
+        except AttributeError:
+            pass
+
+        # Both parsers accept bytes, so the body is not decoded beforehand
+        body = await self.get_body()
+        if orjson is not None and _LONG_DIGITS.search(body) is None:
+            try:
+                self._json = orjson.loads(body)
+                return self._json
+            except orjson.JSONDecodeError:
+                pass
+        self._json = loads(body)
         return self._json
 
 
+_HK_CONTENT_TYPE = b"content-type"
+_HK_CONTENT_LENGTH = b"content-length"
+_HK_LOCATION = b"location"
+_CT_JSON = b"application/json"
+_REDIRECT_STATUS = frozenset(range(300, 400))
+_NO_BODY_STATUS = frozenset({204, 304})
+# Encoded content-length values for small bodies
+_CL_CACHE_SIZE = 1024
+_CL_CACHE = [str(n).encode() for n in range(_CL_CACHE_SIZE)]
+# Encoded content-type values keyed by (content_type, charset)
+_COMMON_CONTENT_TYPES: dict[tuple[str, str], bytes] = {
+    ("text/plain", "utf-8"): b"text/plain; charset=utf-8",
+    ("text/html", "utf-8"): b"text/html; charset=utf-8",
+    ("application/json", "utf-8"): b"application/json; charset=utf-8",
+}
+# Other encoded content-type values, cleared when full
+_CT_CACHE_MAX_SIZE = 256
+_CT_CACHE: dict[tuple[str, str], bytes] = {}
+
+# Types `json` can't serialize are passed through, so orjson fails on them too
+_ORJSON_OPTIONS = (
+    orjson.OPT_NON_STR_KEYS
+    | orjson.OPT_PASSTHROUGH_DATETIME
+    | orjson.OPT_PASSTHROUGH_DATACLASS
+    if orjson is not None
+    else 0
+)
+
+
+def _dump_json(content: dict, charset: str) -> bytes:
+    if orjson is not None and charset == "utf-8":
+        try:
+            return orjson.dumps(content, option=_ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            # e.g. integers wider than 64 bits, which `json` can serialize, or
+            # passed-through types, which `json` rejects like without orjson
+            pass
+    return dumps(content, ensure_ascii=False).encode(charset)
+
+
 async def response(
     content: bytes | str | dict | None,
     *,
@@ -239,7 +497,10 @@ async def response(
     """Generates a response dictionary.
 
     Args:
-        content (bytes, str, dict, optional): Content of response body.
+        content (bytes, str, dict, optional): Content of response body. A dict is
+            serialized as JSON, by orjson if it's installed and charset is utf-8.
+            Output of orjson is compact and has NaN or infinite floats as null.
+            UUID and enum values are only serialized by orjson.
         content_type (str): Defaults to "text/plain".
         status (int): Defaults to 200.
         headers (dict, optional): Defaults to None.
@@ -262,35 +523,65 @@ async def response(
     Raises:
         ValueError: If redirect content is not a string.
     """
-    if headers is None:
-        headers = {}
-
-    if 300 <= status < 400:
+    location = None
+    if status in _REDIRECT_STATUS:
         if not isinstance(content, str):
             raise ValueError("Redirect url must be a string")
-        headers["location"] = quote(content, safe=":/%#?=")
+        location = quote(content, safe=":/%#?=")
         content = None
 
-    match content:
-        case bytes():
-            body = content
-        case str():
-            body = content.encode(charset)
-        case dict():
-            body = dumps(content, ensure_ascii=False, indent=None).encode(charset)
-        case _:
-            body = b""
+    if isinstance(content, str):
+        body = content.encode(charset)
+    elif isinstance(content, bytes):
+        body = content
+    elif isinstance(content, dict):
+        body = _dump_json(content, charset)
+    else:
+        body = b""
 
+    b_content_type: bytes | None
     if isinstance(content, dict):
-        headers["content-type"] = "application/json"
+        b_content_type = _CT_JSON
     elif content is not None:
-        headers["content-type"] = f"{content_type}; charset={charset}"
-
-    if status >= 200 and status != 204:
-        headers.setdefault("content-length", str(len(body)))
+        ct_key = (content_type, charset)
+        b_content_type = _COMMON_CONTENT_TYPES.get(ct_key) or _CT_CACHE.get(ct_key)
+        if b_content_type is None:
+            b_content_type = f"{content_type}; charset={charset}".encode()
+            if len(_CT_CACHE) >= _CT_CACHE_MAX_SIZE:
+                _CT_CACHE.clear()
+            _CT_CACHE[ct_key] = b_content_type
+    else:
+        b_content_type = None
+
+    with_length = status >= 200 and status not in _NO_BODY_STATUS
+
+    raw: list[tuple[bytes, bytes]] = []
+    if headers:
+        # Custom headers are kept unless they are set below, case-insensitively
+        for key, value in headers.items():
+            lower_key = key.lower()
+            if lower_key == "content-length":
+                with_length = False
+            elif (lower_key == "location" and location is not None) or (
+                lower_key == "content-type" and b_content_type is not None
+            ):
+                continue
+            raw.append((key.encode(), value.encode()))
+
+    if location is not None:
+        raw.append((_HK_LOCATION, location.encode()))
+    if b_content_type is not None:
+        raw.append((_HK_CONTENT_TYPE, b_content_type))
+    if with_length:
+        length = len(body)
+        if length < _CL_CACHE_SIZE:
+            b_length = _CL_CACHE[length]
+        else:
+            b_length = str(length).encode()
+        raw.append((_HK_CONTENT_LENGTH, b_length))
 
     return {
         "status": status,
-        "headers": MutableHeaders(headers).raw,
+        "headers": raw,
         "body": body,
     }
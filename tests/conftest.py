@@ -1,10 +1,62 @@
 from logging import getLogger
+from types import MappingProxyType
 
 import pytest
 
+from cilantro import Request, core
+
+# Copied and updated for every request made by `make_request`
+SCOPE_TEMPLATE = MappingProxyType(
+    {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/",
+        "query_string": b"",
+        "headers": [
+            (b"host", b"localhost"),
+        ],
+    }
+)
+
 
 @pytest.fixture(autouse=True)
 def enable_logs():
     logger = getLogger("cilantro")
     logger.setLevel("DEBUG")
     logger.propagate = True
+
+
+@pytest.fixture(params=["orjson", "json"])
+def json_backend(request, monkeypatch):
+    """Runs a test with orjson, if it's installed, and with the json module."""
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(core, "orjson", None)
+    return request.param
+
+
+@pytest.fixture
+def make_request():
+    """Makes requests from scope overrides and the events to be received.
+
+    Once the given events run out, the client is considered disconnected.
+    """
+
+    def _make_request(events=(), **scope):
+        events = iter(events)
+
+        async def receive():
+            return next(events, {"type": "http.disconnect"})
+
+        async def send(_):
+            pass
+
+        scope = dict(SCOPE_TEMPLATE, **scope)
+        # The template's headers list must not be shared between requests
+        scope["headers"] = list(scope["headers"])
+        return Request(scope, receive, send)
+
+    return _make_request
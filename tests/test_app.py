@@ -1,6 +1,11 @@
+from dataclasses import dataclass
+from datetime import date, datetime, time
+from json import loads
+from urllib.parse import parse_qs
+
 import pytest
 
-from cilantro import Cilantro, Headers, MutableHeaders, Request
+from cilantro import Cilantro, Headers, MutableHeaders, core
 from cilantro.core import response
 
 
@@ -25,10 +30,20 @@ def test_headers_internal():
     )
 
     assert list(headers_mutable) == ["host", "accept"]
+    assert list(headers.keys()) == ["host", "accept"]
+    assert list(headers.values()) == [["localhost"], ["text/html", "text/plain"]]
+    assert dict(headers.items()) == {
+        "host": ["localhost"],
+        "accept": ["text/html", "text/plain"],
+    }
     assert len(headers_mutable) == 2
     assert "host" in headers_mutable and "accept" in headers_mutable
 
     assert headers == headers_mutable
+    assert headers == Headers(list(reversed(raw)))
+    assert headers != Headers(raw[:2])
+    assert headers != Headers(raw[:2] + [(b"User-Agent", b"curl")])
+    assert headers != Headers(raw[:2] + [(b"Accept", b"text/css")])
     assert headers != {"host": ["localhost"], "accept": ["text/html", "text/plain"]}
 
     assert (
@@ -62,6 +77,14 @@ def test_init_headers_with_dict():
     assert headers.get("accept") == "text/html"
 
 
+def test_init_headers_with_dict_snapshot():
+    raw_dict = {"Host": "localhost"}
+    headers = Headers(raw_dict)
+    raw_dict["Accept"] = "text/html"
+    assert headers.raw == [(b"Host", b"localhost")]
+    assert "accept" not in headers
+
+
 def test_headers_read():
     raw = [
         (b"Host", b"localhost"),
@@ -72,6 +95,7 @@ def test_headers_read():
     assert headers.raw == raw
 
     assert headers.get("host") == headers.get("Host") == "localhost"
+    assert headers.get("HOST") == "localhost"
     assert headers.get("accept") == headers.get("Accept") == "text/html"
     assert headers.get("user-agent") is None
     assert headers.get("user-agent", "text/html") == "text/html"
@@ -83,6 +107,14 @@ def test_headers_read():
     assert headers.list("user-agent") == []
 
 
+def test_headers_non_ascii():
+    headers = Headers([(b"X-Name", "ÄÖ".encode()), ("X-Ä".encode(), b"1")])
+    assert headers.get("x-name") == "äö"
+    assert headers.get("x-ä") == "1"
+    assert headers.get("X-Ä") == "1"
+    assert "x-ä" in headers
+
+
 def test_headers_with_duplicate_input():
     raw = [
         (b"Host", b"localhost"),
@@ -111,6 +143,23 @@ def test_headers_write():
     assert headers.get("accept") is None
 
 
+def test_headers_append_many():
+    headers = MutableHeaders([])
+    cookies = [f"id={i}" for i in range(20)]
+    for cookie in cookies + cookies:
+        headers.append("Set-Cookie", cookie)
+    assert headers.list("set-cookie") == cookies
+
+    headers.set("set-cookie", "id=0")
+    for cookie in cookies:
+        headers.append("set-cookie", cookie)
+    assert headers.list("set-cookie") == cookies
+
+    del headers["set-cookie"]
+    headers.append("set-cookie", "id=1")
+    assert headers.list("set-cookie") == ["id=1"]
+
+
 @pytest.mark.anyio
 @pytest.mark.parametrize(
     ["content", "options", "status", "headers", "body"],
@@ -155,22 +204,31 @@ def test_headers_write():
             b"<h1>Hello world!</h1>",
         ),
         (
-            {"message": "Hello world!"},
+            "https://github.com/iamgodot/cilantro",
+            {"status": 308},
+            308,
+            [
+                (b"location", b"https://github.com/iamgodot/cilantro"),
+                (b"content-length", b"0"),
+            ],
+            b"",
+        ),
+        (
+            b"x" * 2048,
             {},
             200,
             [
-                (b"content-type", b"application/json"),
-                (b"content-length", b"27"),
+                (b"content-type", b"text/plain; charset=utf-8"),
+                (b"content-length", b"2048"),
             ],
-            b'{"message": "Hello world!"}',
+            b"x" * 2048,
         ),
         (
-            "https://github.com/iamgodot/cilantro",
-            {"status": 308},
-            308,
+            "/cached",
+            {"status": 304},
+            304,
             [
-                (b"location", b"https://github.com/iamgodot/cilantro"),
-                (b"content-length", b"0"),
+                (b"location", b"/cached"),
             ],
             b"",
         ),
@@ -192,6 +250,52 @@ async def test_response_content(content, options, status, headers, body):
     }
 
 
+@pytest.mark.anyio
+@pytest.mark.parametrize("charset", ["utf-8", "utf-16"])
+async def test_response_json(json_backend, charset):
+    content = {"message": "Hello world!", 1: "ü"}
+    res = await response(content, charset=charset)
+    assert res["status"] == 200
+    assert res["headers"] == [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(res["body"])).encode()),
+    ]
+    assert loads(res["body"].decode(charset)) == {
+        "message": "Hello world!",
+        "1": "ü",
+    }
+
+
+@pytest.mark.anyio
+async def test_response_json_big_int(json_backend):
+    res = await response({"n": 2**70})
+    assert loads(res["body"]) == {"n": 2**70}
+
+
+@dataclass
+class Point:
+    x: int
+    y: int
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "value", [datetime(2024, 1, 1), date(2024, 1, 1), time(), Point(1, 2)]
+)
+async def test_response_json_unserializable(json_backend, value):
+    with pytest.raises(TypeError):
+        await response({"v": value})
+
+
+@pytest.mark.anyio
+async def test_response_json_nan(json_backend):
+    res = await response({"n": float("nan")})
+    if json_backend == "orjson":
+        assert res["body"] == b'{"n":null}'
+    else:
+        assert res["body"] == b'{"n": NaN}'
+
+
 @pytest.mark.anyio
 @pytest.mark.parametrize(
     ["headers_in", "headers_out"],
@@ -218,11 +322,35 @@ async def test_response_content(content, options, status, headers, body):
                 (b"content-length", b"12"),
             ],
         ),
+        (
+            {"Content-Type": "text/html", "Content-Length": "5"},
+            [
+                (b"Content-Length", b"5"),
+                (b"content-type", b"text/plain; charset=utf-8"),
+            ],
+        ),
     ],
 )
 async def test_response_headers(headers_in, headers_out):
+    headers_in_copy = None if headers_in is None else dict(headers_in)
     res = await response("Hello world!", headers=headers_in)
     assert res["headers"] == headers_out
+    assert headers_in == headers_in_copy
+
+
+@pytest.mark.anyio
+async def test_response_content_type_cache_bounded(monkeypatch):
+    monkeypatch.setattr(core, "_CT_CACHE", {})
+    for i in range(core._CT_CACHE_MAX_SIZE * 2):
+        res = await response("Hello world!", content_type=f"text/x-{i}")
+        assert res["headers"][0] == (
+            b"content-type",
+            f"text/x-{i}; charset=utf-8".encode(),
+        )
+        assert len(core._CT_CACHE) <= core._CT_CACHE_MAX_SIZE
+    # Common content types are still served after the cache is cleared
+    res = await response("Hello world!")
+    assert res["headers"][0] == (b"content-type", b"text/plain; charset=utf-8")
 
 
 @pytest.mark.anyio
@@ -233,36 +361,12 @@ async def test_response_redirect_url(content):
 
 
 @pytest.mark.anyio
-async def test_request_basic():
-    scope = {
-        "type": "http",
-        "http_version": "1.1",
-        "method": "GET",
-        "scheme": "http",
-        "path": "/index",
-        "query_string": b"foo=bar&foo=bat&a=b",
-        "headers": [
-            (b"host", b"localhost"),
-        ],
-    }
-
-    request_body_completed = False
-
-    async def receive():
-        nonlocal request_body_completed
-        if request_body_completed:
-            return {"type": "http.disconnect"}
-        request_body_completed = True
-        return {
-            "type": "http.request",
-            "body": b"Hello world!",
-            "more_body": False,
-        }
-
-    async def send(_):
-        pass
-
-    request = Request(scope, receive, send)
+async def test_request_basic(make_request):
+    request = make_request(
+        [{"type": "http.request", "body": b"Hello world!", "more_body": False}],
+        path="/index",
+        query_string=b"foo=bar&foo=bat&a=b",
+    )
     assert request.method == "GET"
     assert request.url == "http://localhost/index?foo=bar&foo=bat&a=b"
     assert request.scheme == "http"
@@ -270,9 +374,14 @@ async def test_request_basic():
     assert request.http_version == "1.1"
     assert request.headers.get("host") == "localhost"
     assert request.query_params == {"foo": ["bar", "bat"], "a": ["b"]}
+    query_params = request.query_params
+    query_params.pop("a")
+    query_params["foo"].append("baz")
+    assert request.query_params == {"foo": ["bar", "bat"], "a": ["b"]}
 
-    request_copy = Request(scope, receive, send)
+    request_copy = make_request(path="/index", query_string=b"foo=bar&foo=bat&a=b")
     assert request != request_copy
+    assert request == request
 
     assert str(request) == 'Request("http://localhost/index?foo=bar&foo=bat&a=b")'
 
@@ -283,6 +392,26 @@ async def test_request_basic():
     assert body == b"Hello world!"
 
 
+@pytest.mark.parametrize(
+    "query_string",
+    [
+        b"",
+        b"page=2",
+        b"page=",
+        b"page",
+        b"=2",
+        b"a=b=c",
+        b"q=hello+world",
+        b"q=caf%C3%A9",
+        b"q=caf\xc3\xa9",
+        b"a=1&a=2&b=&c",
+    ],
+)
+def test_request_query_params(make_request, query_string):
+    request = make_request(query_string=query_string)
+    assert request.query_params == parse_qs(query_string.decode())
+
+
 @pytest.mark.parametrize(
     ["scheme", "server", "url"],
     [
@@ -292,90 +421,128 @@ async def test_request_basic():
         ["http", (), "/"],
     ],
 )
-def test_request_host(scheme, server, url):
-    scope = {
-        "type": "http",
-        "http_version": "1.1",
-        "method": "GET",
-        "scheme": scheme,
-        "path": "/",
-        "query_string": b"",
-        "headers": [],
-        "server": server,
-    }
-
-    async def receive():
-        return {}
-
-    async def send(_):
-        pass
-
-    request = Request(scope, receive, send)
+def test_request_host(make_request, scheme, server, url):
+    request = make_request(scheme=scheme, server=server, headers=[])
     assert request.url == url
+    assert request.query_params == {}
+    assert request.scheme == scheme
+    assert request.path == "/"
 
 
-@pytest.mark.anyio
-async def test_request_disconnected_during_body():
-    scope = {
-        "type": "http",
-        "http_version": "1.1",
-        "method": "GET",
-        "scheme": "http",
-        "path": "/",
-        "query_string": b"",
-        "headers": [
-            (b"host", b"localhost"),
+@pytest.mark.parametrize("headers_first", [True, False])
+@pytest.mark.parametrize(
+    ["host", "url_host"],
+    [
+        [b"LocalHost:8000", "localhost:8000"],
+        ["ÄÖ.com".encode(), "äö.com"],
+    ],
+)
+def test_request_host_header(make_request, headers_first, host, url_host):
+    request = make_request(
+        server=("127.0.0.1", 80),
+        headers=[
+            (b"Accept", b"text/html"),
+            (b"Host", host),
         ],
-    }
+    )
+    if headers_first:
+        assert request.headers.get("host") == url_host
+    assert request.url == f"http://{url_host}/"
 
-    request_body_completed = False
 
-    async def receive():
-        nonlocal request_body_completed
-        if request_body_completed:
-            return {"type": "http.disconnect"}
-        request_body_completed = True
-        return {
-            "type": "http.request",
-            "body": b"Hello world!",
-            "more_body": True,
-        }
+@pytest.mark.anyio
+async def test_request_disconnected_during_body(make_request):
+    request = make_request(
+        [{"type": "http.request", "body": b"Hello world!", "more_body": True}]
+    )
+    with pytest.raises(RuntimeError):
+        await request.get_body()
 
-    async def send(_):
-        pass
+    # The disconnect is remembered, so receive is not awaited again
+    async def receive_forbidden():
+        raise AssertionError("receive called after disconnect")
 
-    request = Request(scope, receive, send)
+    request._receive = receive_forbidden
     with pytest.raises(RuntimeError):
         await request.get_body()
 
 
+CHUNKED_BODY_EVENTS = [
+    {"type": "http.request", "body": b"Hello", "more_body": True},
+    {"type": "http.request", "more_body": True},
+    {"type": "http.request", "body": b" world!", "more_body": False},
+]
+
+
 @pytest.mark.anyio
-async def test_request_get_json():
-    scope = {
-        "type": "http",
-        "http_version": "1.1",
-        "method": "GET",
-        "scheme": "http",
-        "path": "/",
-        "query_string": b"",
-        "headers": [
-            (b"host", b"localhost"),
-        ],
-    }
+async def test_request_body_in_chunks(make_request):
+    request = make_request(CHUNKED_BODY_EVENTS, method="POST")
+    body = await request.get_body()
+    assert body == b"Hello world!"
+    assert isinstance(body, bytes)
 
-    async def receive():
-        return {
-            "type": "http.request",
-            "body": b'{"message": "Hello world!"}',
-            "more_body": False,
-        }
 
-    async def send(_):
-        pass
+@pytest.mark.anyio
+async def test_request_stream(make_request):
+    request = make_request(CHUNKED_BODY_EVENTS, method="POST")
+    chunks = [chunk async for chunk in request.stream()]
+    assert chunks == [b"Hello", b" world!"]
+    with pytest.raises(RuntimeError):
+        await request.get_body()
+    with pytest.raises(RuntimeError):
+        [chunk async for chunk in request.stream()]
+
+    # The cached body is streamed once it's read
+    request = make_request(
+        [{"type": "http.request", "body": b"Hello world!"}], method="POST"
+    )
+    assert await request.get_body() == b"Hello world!"
+    chunks = [chunk async for chunk in request.stream()]
+    assert chunks == [b"Hello world!"]
 
-    request = Request(scope, receive, send)
+
+@pytest.mark.anyio
+async def test_request_get_json(make_request, json_backend):
+    request = make_request(
+        [
+            {
+                "type": "http.request",
+                "body": b'{"message": "Hello world!"}',
+                "more_body": False,
+            }
+        ]
+    )
     json_body = await request.get_json()
     assert json_body == {"message": "Hello world!"}
     # Cache is used this time
     json_body = await request.get_json()
     assert json_body == {"message": "Hello world!"}
+
+
+@pytest.mark.anyio
+async def test_request_get_json_backend_differences(make_request, json_backend):
+    request = make_request(
+        [
+            {
+                "type": "http.request",
+                "body": b'{"n": 123, "x": NaN}',
+            }
+        ]
+    )
+    json_body = await request.get_json()
+    # Falls back to `json` for NaN
+    assert json_body["n"] == 123
+    assert json_body["x"] != json_body["x"]
+
+    # Integers wider than 64 bits stay exact with both backends
+    for n in (2**64, -(2**63) - 1, 123456789012345678901234567890):
+        request = make_request(
+            [{"type": "http.request", "body": f'{{"n": {n}}}'.encode()}]
+        )
+        json_body = await request.get_json()
+        assert json_body == {"n": n}
+        assert isinstance(json_body["n"], int)
+
+    request = make_request([{"type": "http.request", "body": b"foobar"}])
+    with pytest.raises(ValueError):
+        await request.get_json()